@@ -1,12 +1,30 @@
 import streamlit as st
 import requests
-import shapefile
 import tempfile
 import os
+import json
+import re
+import time
+import queue
+import itertools
 import zipfile
 import shutil
+import struct
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# --- Optional faster DEFLATE (ISA-L) for reading and writing ZIPs ---
+# zipfile looks up zlib/crc32 at call time, so swapping in the API-compatible
+# isal_zlib module accelerates both archive extraction and the result ZIP.
+try:
+    from isal import isal_zlib
+    zipfile.zlib = isal_zlib
+    zipfile.crc32 = isal_zlib.crc32
+except ImportError:
+    pass
 
 # --- Configuration to ignore SSL warnings ---
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -14,174 +32,667 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 # --- Constants ---
 DATASET_ID = "kadastra-informacijas-sistemas-atverti-telpiskie-dati"
 CKAN_API_URL = f"https://data.gov.lv/dati/lv/api/3/action/package_show?id={DATASET_ID}"
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+MAX_DOWNLOAD_WORKERS = 8
+# Result archive: fastest DEFLATE level. Level 1 is several times quicker than
+# the default 6 and only slightly larger; shapefiles are raw binary, so storing
+# them uncompressed would make the download much larger.
+# (ISA-L accepts levels 0-3, so 1 is valid with either backend.)
+RESULT_COMPRESSLEVEL = 1
+# Territory list cache on disk; the listing changes at most daily
+TERRITORY_CACHE_PATH = os.path.join(tempfile.gettempdir(), f"vzd_kk_{DATASET_ID}.json")
+TERRITORY_CACHE_TTL = 24 * 60 * 60
+# Cadastre data is always in LKS-92 / Latvia TM (EPSG:3059)
+LKS92_WKT = (
+    'PROJCS["LKS_1992_Latvia_TM",GEOGCS["GCS_LKS_1992",DATUM["D_Latvia_1992",'
+    'SPHEROID["GRS_1980",6378137.0,298.257222101]],PRIMEM["Greenwich",0.0],'
+    'UNIT["Degree",0.0174532925199433]],PROJECTION["Transverse_Mercator"],'
+    'PARAMETER["False_Easting",500000.0],PARAMETER["False_Northing",-6000000.0],'
+    'PARAMETER["Central_Meridian",24.0],PARAMETER["Scale_Factor",0.9996],'
+    'PARAMETER["Latitude_Of_Origin",0.0],UNIT["Meter",1.0]]'
+)
+# Main .shp of each layer, e.g. KKParcel but not KKParcelPart
+LAYER_PATTERNS = {
+    layer: re.compile(rf"^(?!.*{layer}Part).*{layer}.*\.(?i:shp)$")
+    for layer in ("KKParcel", "KKBuilding")
+}
+# (label, output name) of each layer
+LAYER_OUTPUTS = {
+    "KKParcel": ("Parcels", "Parcels_merged"),
+    "KKBuilding": ("Buildings", "Buildings_merged"),
+}
+# Archives waiting per layer. When a merger falls behind, indexing blocks on its
+# queue and no new downloads are started until it catches up.
+MERGE_QUEUE_SIZE = 4
+# Tail of each archive fetched up front to read its file listing
+CENTRAL_DIR_PEEK_BYTES = 128 * 1024
 
 # --- Helper Functions ---
 
-@st.cache_data
-def get_territory_list():
-    """Fetches the list of territories, bypassing SSL checks."""
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
+@st.cache_resource(show_spinner=False)
+def get_session():
+    """Returns the shared session, created once per server process.
+
+    Every API call and download reuses its pooled keep-alive connections,
+    across reruns and user sessions, instead of paying a new TCP+TLS handshake
+    each time. Transient failures are retried with exponential backoff
+    (0.5s, 1s, 2s, ...).
+    """
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+        ),
+    ))
+    session.verify = False
+    session.headers.update(HEADERS)
+    return session
+
+def read_territory_cache(max_age=None):
+    """Returns the cached territory list, or None if missing or older than max_age seconds."""
+    try:
+        if max_age is not None and time.time() - os.path.getmtime(TERRITORY_CACHE_PATH) > max_age:
+            return None
+        with open(TERRITORY_CACHE_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_territory_cache(resources):
+    """Writes the territory list atomically so readers never see a partial file."""
+    tmp_path = f"{TERRITORY_CACHE_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(resources, f, ensure_ascii=False)
+        os.replace(tmp_path, TERRITORY_CACHE_PATH)
+    except OSError as e:
+        print(f"Could not write territory cache: {e}")
+
+@st.cache_data(ttl=TERRITORY_CACHE_TTL)
+def fetch_territory_list():
+    """Fetches the list of territories, bypassing SSL checks.
+
+    Served from a disk cache for up to a day. Raises on failure, so only a good
+    list is memoized.
+    """
+    cached = read_territory_cache(max_age=TERRITORY_CACHE_TTL)
+    if cached:
+        return cached
+
+    response = get_session().get(CKAN_API_URL, timeout=10)
+    response.raise_for_status()
+    data = response.json()
     
+    resources = {}
+    if data.get('success'):
+        for res in data['result']['resources']:
+            fmt = res.get('format', '').upper()
+            url = res.get('url', '')
+            
+            if fmt in ['SHP', 'ZIP'] or url.lower().endswith('.zip'):
+                name = res.get('name')
+                if name and url:
+                    resources[name] = url
+    if not resources:
+        raise ValueError("no territories in the API response")
+    write_territory_cache(resources)
+    return resources
+
+def get_territory_list():
+    """Returns the territory list, falling back to a stale cache if the API fails."""
     try:
-        response = requests.get(CKAN_API_URL, headers=headers, verify=False, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        resources = {}
-        if data.get('success'):
-            for res in data['result']['resources']:
-                fmt = res.get('format', '').upper()
-                url = res.get('url', '')
-                
-                if fmt in ['SHP', 'ZIP'] or url.lower().endswith('.zip'):
-                    name = res.get('name')
-                    if name and url:
-                        resources[name] = url
-        return resources
+        return fetch_territory_list()
     except Exception as e:
+        stale = read_territory_cache()
+        if stale:
+            st.warning(f"API Error: {e}. Using a cached territory list.")
+            return stale
         st.error(f"API Error: {e}")
         return {}
 
 def get_sort_key(text):
     """Sorts '1. Name' before '10. Name'."""
-    try:
-        first_part = text.split('.')[0]
-        if first_part.isdigit():
-            return int(first_part)
-    except:
-        pass
+    # Leading ASCII digits, followed by '.' or the end of the text
+    i = 0
+    n = len(text)
+    while i < n and "0" <= text[i] <= "9":
+        i += 1
+    if i and (i == n or text[i] == "."):
+        return int(text[:i])
     return 999999
 
-def merge_shapefiles(file_paths, output_path):
-    """Merges multiple shapefiles using pyshp."""
-    if not file_paths:
-        return False
+def read_shapefile_header(archive, members):
+    """Reads the .shp/.shx/.dbf headers needed for a byte-level merge.
 
-    w = shapefile.Writer(output_path)
-    
-    # Find first valid file
-    first_sf = None
-    for path in file_paths:
-        try:
-            temp_sf = shapefile.Reader(path)
-            if len(temp_sf.fields) > 1: 
-                first_sf = temp_sf
-                break
-        except:
-            continue
-            
-    if not first_sf:
-        print(f"No valid shapefiles found for {output_path}")
-        return False
-
-    # Copy fields
-    for field in first_sf.fields:
-        if field[0] == 'DeletionFlag': 
-            continue
-        w.field(*field)
-
-    # Merge
-    for path in file_paths:
-        try:
-            with shapefile.Reader(path) as sf:
-                if len(sf.fields) != len(first_sf.fields):
-                    continue
-                for shape_rec in sf.iterShapeRecords():
-                    w.record(*shape_rec.record)
-                    w.shape(shape_rec.shape)
-        except Exception as e:
-            print(f"Error reading {path}: {e}")
-
-    w.close()
-    
-    # Copy .prj
-    first_prj = file_paths[0].replace(".shp", ".prj")
-    output_prj = output_path.replace(".shp", ".prj")
-    if os.path.exists(first_prj):
-        shutil.copy(first_prj, output_prj)
-        
-    return True
+    `members` maps lower-case extensions to entry names inside `archive`.
+    Only fixed-size headers are read, so validation costs the same for any
+    file size; the .shx isn't decompressed at all.
+    """
+    with archive.open(members[".shp"]) as f:
+        shp_header = f.read(100)
+    if len(shp_header) < 100 or struct.unpack(">i", shp_header[:4])[0] != 9994:
+        raise ValueError("not a shapefile")
 
-def process_territories(selected_names, resource_map, selected_types):
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    total = len(selected_names)
-    
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    with archive.open(members[".dbf"]) as f:
+        dbf_prefix = f.read(32)
+        if len(dbf_prefix) < 32:
+            raise ValueError("not a shapefile")
+        num_records, header_length, record_length = struct.unpack("<IHH", dbf_prefix[4:12])
+        # The header needs at least its 0x0D terminator; rows at least a deletion flag
+        if header_length < 33 or record_length < 1:
+            raise ValueError("not a shapefile")
+        dbf_header = dbf_prefix + f.read(header_length - 32)
+
+    # Field descriptors are 32 bytes each, terminated by 0x0D
+    fields = []
+    for pos in range(32, header_length - 1, 32):
+        desc = dbf_header[pos:pos + 32]
+        if desc[:1] == b"\r" or len(desc) < 32:
+            break
+        fields.append((desc[:11].split(b"\0")[0], desc[11:12], desc[16], desc[17]))
+
+    # Every shape has one 8-byte index entry after the 100-byte header, so the
+    # shape count follows from the entry's size in the ZIP directory
+    shx_records = (archive.getinfo(members[".shx"]).file_size - 100) // 8
+
+    return {
+        "name": members[".shp"],
+        "shape_type": struct.unpack("<i", shp_header[32:36])[0],
+        "bbox": struct.unpack("<4d", shp_header[36:68]),
+        "zm": struct.unpack("<4d", shp_header[68:100]),
+        "shp_header": shp_header,
+        "dbf_header": dbf_header,
+        "num_records": num_records,
+        "header_length": header_length,
+        "record_length": record_length,
+        "fields": fields,
+        # Byte layout of a row; names don't affect it, so files whose layouts
+        # match can have their rows copied without re-fitting
+        "layout": (record_length, tuple(field[1:] for field in fields)),
+        "shx_records": shx_records,
     }
 
-    # Define what we are looking for
-    do_parcels = "KKParcel" in selected_types
-    do_buildings = "KKBuilding" in selected_types
+def copy_bytes(src, dst, length, chunk_size=1 << 20):
+    """Copies exactly `length` bytes from one file object to another."""
+    while length > 0:
+        chunk = src.read(min(chunk_size, length))
+        if not chunk:
+            raise ValueError("unexpected end of file")
+        dst.write(chunk)
+        length -= len(chunk)
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        parcels_to_merge = []
-        buildings_to_merge = []
-        
-        # 1. DOWNLOAD & EXTRACT LOOP
-        for idx, territory_name in enumerate(selected_names):
-            url = resource_map[territory_name]
-            status_text.text(f"Downloading ({idx+1}/{total}): {territory_name}...")
-            
+def iter_shp_records(f, count):
+    """Yields the content length and content of the first `count` records of an open .shp."""
+    f.read(100)
+    for _ in range(count):
+        _, content_length = struct.unpack(">ii", f.read(8))
+        if content_length < 0:
+            raise ValueError("negative record length")
+        content = f.read(2 * content_length)
+        if len(content) < 2 * content_length:
+            raise ValueError("unexpected end of file")
+        yield content_length, content
+
+def build_shp_header(inputs, file_words):
+    """Builds a merged .shp header: the combined shape type and extent, and the
+    given file length in 16-bit words."""
+    non_empty = [info for info in inputs if info["num_records"]] or inputs[:1]
+    bbox = (
+        min(i["bbox"][0] for i in non_empty), min(i["bbox"][1] for i in non_empty),
+        max(i["bbox"][2] for i in non_empty), max(i["bbox"][3] for i in non_empty),
+    )
+    zm = (
+        min(i["zm"][0] for i in non_empty), max(i["zm"][1] for i in non_empty),
+        min(i["zm"][2] for i in non_empty), max(i["zm"][3] for i in non_empty),
+    )
+    header = bytearray(inputs[0]["shp_header"])
+    struct.pack_into("<i4d4d", header, 32, non_empty[0]["shape_type"], *bbox, *zm)
+    struct.pack_into(">i", header, 24, file_words)
+    return header
+
+def dbf_field_converter(src, dst):
+    """Returns a function that re-fits a raw .dbf value from field `src` to
+    field `dst`, or None when their type, size and decimals already match."""
+    if src[1:] == dst[1:]:
+        return None
+    _, field_type, size, decimal = dst
+    if field_type in (b"N", b"F"):
+        if src[3] != decimal:
+            def convert(raw):
+                text = raw.strip()
+                try:
+                    text = b"%.*f" % (decimal, float(text))
+                except ValueError:
+                    pass  # Blank or '*' null values are kept as they are
+                return text.rjust(size)[:size]
+            return convert
+        return lambda raw: raw.strip().rjust(size)[:size]
+    return lambda raw: raw.rstrip().ljust(size)[:size]
+
+class LayerMerger:
+    """Merges one layer incrementally as territory archives arrive.
+
+    Records are appended to uncompressed spool files in arrival order, so the
+    merge overlaps the downloads; the result ZIP is written once at the end,
+    when header totals are known. The first valid input sets the output
+    fields; inputs that can't be merged in full (no fields, a different field
+    count or shape type, or .shx and .dbf disagreeing on the record count)
+    raise, so they are rolled back and reported in `failed`.
+    """
+
+    def __init__(self, spool_dir, name):
+        self.shp = open(os.path.join(spool_dir, f"{name}.shp.part"), "w+b")
+        self.shx = open(os.path.join(spool_dir, f"{name}.shx.part"), "w+b")
+        self.dbf = open(os.path.join(spool_dir, f"{name}.dbf.part"), "w+b")
+        self.first = None
+        self.included = []
+        self.cpg = None
+        self.shape_type = None
+        self.record_no = 0
+        self.offset = 50  # In 16-bit words, right after the 100-byte header
+        self.failed = []  # zip paths whose layer could not be merged
+
+    def consume(self, sources):
+        """Appends queued (zip_path, members) layers until a None sentinel arrives."""
+        while True:
+            item = sources.get()
+            if item is None:
+                return
+            zip_path, members = item
+            # Roll everything back if a layer fails part-way, keeping the spools
+            # in step and the output schema from a file that actually merged
+            state = (self.shp.tell(), self.shx.tell(), self.dbf.tell(),
+                     self.record_no, self.offset, self.first, self.cpg, self.shape_type)
             try:
-                r = requests.get(url, headers=headers, verify=False, timeout=60)
-                r.raise_for_status()
-                z = zipfile.ZipFile(BytesIO(r.content))
-                
-                for filename in z.namelist():
-                    # Check for PARCELS
-                    if do_parcels and "KKParcel" in filename and "KKParcelPart" not in filename and filename.lower().endswith(".shp"):
-                        base = filename.rsplit('.', 1)[0]
-                        for rf in [f for f in z.namelist() if f.startswith(base)]:
-                            z.extract(rf, temp_dir)
-                        parcels_to_merge.append(os.path.join(temp_dir, filename))
-                    
-                    # Check for BUILDINGS
-                    if do_buildings and "KKBuilding" in filename and "KKBuildingPart" not in filename and filename.lower().endswith(".shp"):
-                        base = filename.rsplit('.', 1)[0]
-                        for rf in [f for f in z.namelist() if f.startswith(base)]:
-                            z.extract(rf, temp_dir)
-                        buildings_to_merge.append(os.path.join(temp_dir, filename))
-                                
+                self.add(zip_path, members)
             except Exception as e:
-                print(f"Failed to process {territory_name}: {e}")
-            
-            progress_bar.progress((idx + 1) / total)
-
-        # 2. MERGE LOOP
-        files_created = []
-
-        # Merge Parcels
-        if parcels_to_merge:
-            status_text.text("Merging Parcels...")
-            p_out = os.path.join(temp_dir, "Parcels_merged.shp")
-            if merge_shapefiles(parcels_to_merge, p_out):
-                files_created.append("Parcels_merged")
-
-        # Merge Buildings
-        if buildings_to_merge:
-            status_text.text("Merging Buildings...")
-            b_out = os.path.join(temp_dir, "Buildings_merged.shp")
-            if merge_shapefiles(buildings_to_merge, b_out):
-                files_created.append("Buildings_merged")
-
-        # 3. ZIP RESULT
-        if files_created:
+                print(f"Error reading {zip_path}:{members.get('.shp')}: {e}")
+                self.failed.append(zip_path)
+                for spool, pos in zip((self.shp, self.shx, self.dbf), state):
+                    spool.seek(pos)
+                    spool.truncate()
+                self.record_no, self.offset, self.first, self.cpg, self.shape_type = state[3:]
+
+    def add(self, zip_path, members):
+        """Appends one shapefile layer, streamed from its archive."""
+        with zipfile.ZipFile(zip_path) as archive:
+            info = read_shapefile_header(archive, members)
+
+            # Find first valid file (at least one attribute field)
+            if self.first is None:
+                if not info["fields"]:
+                    raise ValueError("no attribute fields")
+                self.first = info
+                if ".cpg" in members:
+                    self.cpg = archive.read(members[".cpg"])
+            first = self.first
+
+            if len(info["fields"]) != len(first["fields"]):
+                raise ValueError(f"{len(info['fields'])} fields, expected {len(first['fields'])}")
+            # .shp and .dbf rows must pair up; merging only the shorter count would drop rows
+            if info["num_records"] != info["shx_records"]:
+                raise ValueError(f".dbf has {info['num_records']} records, .shx {info['shx_records']}")
+            num_records = info["num_records"]
+            if num_records:
+                if self.shape_type is None:
+                    self.shape_type = info["shape_type"]
+                elif info["shape_type"] != self.shape_type:
+                    raise ValueError(f"shape type {info['shape_type']}, expected {self.shape_type}")
+
+            # .shp records renumbered, .shx rebuilt from the running offset
+            shx_entries = []
+            with archive.open(members[".shp"]) as f:
+                for content_length, content in iter_shp_records(f, num_records):
+                    self.record_no += 1
+                    self.shp.write(struct.pack(">ii", self.record_no, content_length))
+                    self.shp.write(content)
+                    shx_entries.append(struct.pack(">ii", self.offset, content_length))
+                    self.offset += 4 + content_length
+            self.shx.write(b"".join(shx_entries))
+
+            with archive.open(members[".dbf"]) as f:
+                f.read(info["header_length"])
+                if info["layout"] == first["layout"]:
+                    # Same row layout (the usual case): the body is copied as-is
+                    copy_bytes(f, self.dbf, num_records * info["record_length"])
+                else:
+                    print(f"Warning: {info['name']} has a different field layout; re-fitting its rows")
+                    self.append_remapped_rows(f, info, num_records)
+
+        # Only the header values are needed later
+        self.included.append({
+            "shp_header": info["shp_header"],
+            "shape_type": info["shape_type"],
+            "bbox": info["bbox"],
+            "zm": info["zm"],
+            "num_records": num_records,
+        })
+
+    def append_remapped_rows(self, f, info, num_records):
+        """Re-fits each .dbf row to the output fields, packing into one reusable buffer."""
+        first = self.first
+        packer = struct.Struct("".join(f"{size}s" for _, _, size, _ in first["fields"]))
+        row = bytearray(first["record_length"])
+        unpacker = struct.Struct("".join(f"{size}s" for _, _, size, _ in info["fields"]))
+        converters = [dbf_field_converter(src, dst) for src, dst in zip(info["fields"], first["fields"])]
+        record_length = info["record_length"]
+        for _ in range(num_records):
+            raw = f.read(record_length)
+            if len(raw) < record_length:
+                raise ValueError("unexpected end of file")
+            row[0] = raw[0]  # Deletion flag
+            values = unpacker.unpack_from(raw, 1)
+            packer.pack_into(row, 1, *[
+                convert(value) if convert else value
+                for convert, value in zip(converters, values)
+            ])
+            self.dbf.write(row)
+
+    def write_to(self, output_zip, base_name):
+        """Writes the merged `base_name`.shp/.shx/.dbf/.prj/.cpg into `output_zip`."""
+        if self.first is None or not self.included:
+            print(f"No valid shapefiles found for {base_name}")
+            return False
+
+        shp_header = build_shp_header(self.included, self.offset)
+        shx_header = bytearray(shp_header)
+        struct.pack_into(">i", shx_header, 24, 50 + 4 * self.record_no)
+        dbf_header = bytearray(self.first["dbf_header"])
+        struct.pack_into("<I", dbf_header, 4, self.record_no)
+
+        for ext, header, spool, trailer in [
+            (".shp", shp_header, self.shp, b""),
+            (".shx", shx_header, self.shx, b""),
+            (".dbf", dbf_header, self.dbf, b"\x1a"),
+        ]:
+            with output_zip.open(f"{base_name}{ext}", "w", force_zip64=True) as out:
+                out.write(header)
+                spool.seek(0)
+                shutil.copyfileobj(spool, out, 1 << 20)
+                out.write(trailer)
+
+        output_zip.writestr(f"{base_name}.prj", LKS92_WKT)
+        # Keep the source code page if it declared one
+        output_zip.writestr(f"{base_name}.cpg", self.cpg if self.cpg is not None else "UTF-8")
+
+        return True
+
+    def close(self):
+        for spool in (self.shp, self.shx, self.dbf):
+            spool.close()
+
+def peek_archive_names(url):
+    """Lists the files in a remote ZIP by fetching only its tail.
+
+    Returns None if the listing can't be read this way (no Range support,
+    ZIP64, or a central directory larger than the fetched tail).
+    """
+    with get_session().get(url, headers={"Range": f"bytes=-{CENTRAL_DIR_PEEK_BYTES}"}, stream=True, timeout=30) as r:
+        if r.status_code != 206:
+            return None
+        tail = r.content
+        # Content-Range: bytes <start>-<end>/<total>
+        tail_start = int(r.headers["Content-Range"].split()[1].split("-")[0])
+
+    # End of central directory record
+    eocd_pos = tail.rfind(b"PK\x05\x06")
+    if eocd_pos < 0 or len(tail) - eocd_pos < 22:
+        return None
+    _, _, _, _, entries, cd_size, cd_offset, _ = struct.unpack("<4s4H2LH", tail[eocd_pos:eocd_pos + 22])
+    if entries == 0xFFFF or cd_offset == 0xFFFFFFFF:
+        return None
+
+    pos = cd_offset - tail_start
+    if pos < 0:
+        return None
+
+    names = []
+    for _ in range(entries):
+        header = tail[pos:pos + 46]
+        if len(header) < 46 or header[:4] != b"PK\x01\x02":
+            return None
+        flags = struct.unpack("<H", header[8:10])[0]
+        name_len, extra_len, comment_len = struct.unpack("<3H", header[28:34])
+        raw_name = tail[pos + 46:pos + 46 + name_len]
+        names.append(raw_name.decode("utf-8" if flags & 0x800 else "cp437"))
+        pos += 46 + name_len + extra_len + comment_len
+    return names
+
+def fetch_territory(name, url, dest_dir, patterns):
+    """Streams a single territory archive to a temp file. Runs in a worker thread.
+
+    Returns a None path if the archive listing shows none of the wanted layers.
+    """
+    try:
+        names = peek_archive_names(url)
+    except Exception as e:
+        print(f"Could not peek at {name}: {e}")
+        names = None
+    if names is not None and not any(p.match(n) for n in names for p in patterns):
+        return name, None
+
+    with get_session().get(url, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        with tempfile.NamedTemporaryFile(suffix=".zip", dir=dest_dir, delete=False) as tf:
+            shutil.copyfileobj(r.raw, tf, length=1 << 20)
+    return name, tf.name
+
+def process_territories(layer_names, resource_map, previous_zip=None):
+    """Downloads and merges territories per layer.
+
+    `layer_names` maps each data type ("KKParcel", "KKBuilding") to the
+    territories to merge for it. If `previous_zip` (an earlier result) is
+    given, its merged layers are carried over and the territories are appended.
+
+    Returns the result ZIP bytes (or None) and, per data type, the names of
+    territories whose layer failed, so they can be reported and retried.
+    """
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+    # Every territory is downloaded once, for all the layers wanted from it
+    selected_names = list(dict.fromkeys(name for names in layer_names.values() for name in names))
+    total = len(selected_names)
+    failed = {data_type: set() for data_type in layer_names}
+
+    # Downloads abandoned on a rerun may still be writing into temp_dir
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as temp_dir:
+        # Define what we are looking for: (data type, label, output name, pattern) per selected layer
+        layers = [
+            (data_type, *LAYER_OUTPUTS[data_type], LAYER_PATTERNS[data_type])
+            for data_type in ("KKParcel", "KKBuilding") if layer_names.get(data_type)
+        ]
+        wanted_by = {data_type: set(layer_names[data_type]) for data_type, _, _, _ in layers}
+
+        # One merger thread per layer, fed through a bounded queue, so merging
+        # overlaps the downloads instead of waiting for all of them
+        mergers = {base_name: LayerMerger(temp_dir, base_name) for _, _, base_name, _ in layers}
+        queues = {base_name: queue.Queue(maxsize=MERGE_QUEUE_SIZE) for _, _, base_name, _ in layers}
+        zip_names = {}
+
+        previous_path = None
+        if previous_zip:
+            previous_path = os.path.join(temp_dir, "previous.zip")
+            with open(previous_path, "wb") as f:
+                f.write(previous_zip)
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(layers)) as merge_executor:
+                merge_futures = [
+                    merge_executor.submit(mergers[base_name].consume, queues[base_name])
+                    for base_name in mergers
+                ]
+
+                # 1. DOWNLOAD & INDEX LOOP
+                # Downloads run in parallel; indexing and UI updates stay on the main thread.
+                status_text.text(f"Downloading {total} territories...")
+                try:
+                    # The earlier result goes first, so it also keeps setting the output fields
+                    if previous_path:
+                        with zipfile.ZipFile(previous_path) as z:
+                            previous_members = set(z.namelist())
+                        for _, _, base_name, _ in layers:
+                            members = {ext: f"{base_name}{ext}" for ext in (".shp", ".shx", ".dbf", ".cpg")}
+                            if members[".shp"] in previous_members:
+                                queues[base_name].put((previous_path, members))
+
+                    # No `with`: its exit would wait for every queued download
+                    executor = ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS)
+
+                    def submit(name):
+                        patterns = [pattern for data_type, _, _, pattern in layers if name in wanted_by[data_type]]
+                        return executor.submit(fetch_territory, name, resource_map[name], temp_dir, patterns)
+
+                    try:
+                        # Sliding window: a new download starts only as a finished one
+                        # is taken, so a stalled merge also stalls the downloads
+                        pending = iter(selected_names)
+                        in_flight = {}
+                        for name in itertools.islice(pending, MAX_DOWNLOAD_WORKERS):
+                            in_flight[submit(name)] = name
+                        done = 0
+                        while in_flight:
+                            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                            for future in finished:
+                                territory_name = in_flight.pop(future)
+                                for name in itertools.islice(pending, 1):
+                                    in_flight[submit(name)] = name
+                                done += 1
+                                status_text.text(f"Downloaded ({done}/{total}): {territory_name}")
+
+                                try:
+                                    _, zip_path = future.result()
+                                    if zip_path is None:
+                                        print(f"Skipped {territory_name}: no selected layers in archive")
+                                        progress_bar.progress(done / total)
+                                        continue
+                                    zip_names[zip_path] = territory_name
+
+                                    with zipfile.ZipFile(zip_path) as z:
+                                        # Single pass: group entries by base name and note the wanted layers
+                                        by_base = {}
+                                        wanted = []
+                                        for filename in z.namelist():
+                                            base = filename.rsplit('.', 1)[0]
+                                            by_base.setdefault(base, []).append(filename)
+
+                                            for data_type, _, base_name, pattern in layers:
+                                                if territory_name in wanted_by[data_type] and pattern.match(filename):
+                                                    wanted.append((base, base_name))
+                                                    break
+
+                                    # Layers stay in the archive; the mergers stream them out directly
+                                    for base, base_name in wanted:
+                                        members = {os.path.splitext(n)[1].lower(): n for n in by_base[base]}
+                                        queues[base_name].put((zip_path, members))
+
+                                    if not wanted:
+                                        os.remove(zip_path)
+
+                                except Exception as e:
+                                    print(f"Failed to process {territory_name}: {e}")
+                                    for data_type, _, _, _ in layers:
+                                        if territory_name in wanted_by[data_type]:
+                                            failed[data_type].add(territory_name)
+                            
+                                progress_bar.progress(done / total)
+                    except BaseException:
+                        # Streamlit ends a run (rerun/stop) by raising from the next st.*
+                        # call; drop the pending downloads instead of finishing them
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        raise
+                    executor.shutdown()
+                except BaseException:
+                    # Aborted run: drop archives still waiting so the mergers stop promptly
+                    for q in queues.values():
+                        try:
+                            while True:
+                                q.get_nowait()
+                        except queue.Empty:
+                            pass
+                    raise
+                finally:
+                    for q in queues.values():
+                        q.put(None)
+
+                status_text.text(f"Merging {' and '.join(label for _, label, _, _ in layers)}...")
+                for merge_future in merge_futures:
+                    merge_future.result()
+                for data_type, _, base_name, _ in layers:
+                    for zip_path in mergers[base_name].failed:
+                        if zip_path == previous_path:
+                            # Never replace the earlier result with one missing its data
+                            print(f"Could not carry over {base_name} from the previous result")
+                            return None, {}
+                        failed[data_type].add(zip_names[zip_path])
+
+            # 2. WRITE RESULT ZIP
+            files_created = []
             zip_buffer = BytesIO()
-            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-                for base_name in files_created:
-                    base_path = os.path.join(temp_dir, base_name)
-                    for ext in [".shp", ".shx", ".dbf", ".prj", ".cpg"]:
-                        if os.path.exists(base_path + ext):
-                            zip_file.write(base_path + ext, f"{base_name}{ext}")
-            
+            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=RESULT_COMPRESSLEVEL) as zip_file:
+                for _, label, base_name, _ in layers:
+                    status_text.text(f"Writing {label}...")
+                    if mergers[base_name].write_to(zip_file, base_name):
+                        files_created.append(base_name)
+                # Layers this run didn't touch are carried over unchanged
+                if previous_path:
+                    with zipfile.ZipFile(previous_path) as previous:
+                        for item in previous.infolist():
+                            if item.filename.rsplit(".", 1)[0] not in mergers:
+                                zip_file.writestr(item, previous.read(item))
+        finally:
+            for merger in mergers.values():
+                merger.close()
+
+        failed = {
+            data_type: sorted(names, key=get_sort_key)
+            for data_type, names in failed.items() if names
+        }
+        if files_created:
             status_text.text("Done!")
-            return zip_buffer.getvalue()
+            return zip_buffer.getvalue(), failed
         
-        return None
+        return None, failed
+
+def show_last_run(resource_map):
+    """Shows the result of the last run, kept in session state across reruns."""
+    last_run = st.session_state.get("last_run")
+    if not last_run:
+        return
+
+    if last_run["zip_data"]:
+        st.success(f"Merged successfully!")
+        st.download_button(
+            label="Download Merged Data (.zip)",
+            data=last_run["zip_data"],
+            file_name="merged_cadastre_data.zip",
+            mime="application/zip"
+        )
+    else:
+        st.error("No data found for the selected criteria.")
+
+    failed = last_run["failed"]
+    if failed:
+        for data_type, names in failed.items():
+            label = LAYER_OUTPUTS[data_type][0]
+            st.warning(
+                f"{label} failed ({len(names)}): {', '.join(names)}. "
+                f"The archive above does not include their {label.lower()}."
+            )
+        if st.button("Retry failed"):
+            # Only the failed layers are downloaded again and merged into the
+            # earlier archive; if that can't be done, the earlier archive is kept
+            zip_data, failed = process_territories(failed, resource_map, last_run["zip_data"])
+            if zip_data:
+                st.session_state["last_run"] = {"zip_data": zip_data, "failed": failed}
+            st.rerun()
 
 # --- Main App Interface ---
 
@@ -220,15 +731,9 @@ if st.button("Download and Merge", type="primary"):
     elif not data_types:
         st.error("Please select at least one data type (Parcels or Buildings).")
     else:
-        zip_data = process_territories(selected_territories, resource_map, data_types)
-        
-        if zip_data:
-            st.success(f"Merged successfully!")
-            st.download_button(
-                label="Download Merged Data (.zip)",
-                data=zip_data,
-                file_name="merged_cadastre_data.zip",
-                mime="application/zip"
-            )
-        else:
-            st.error("No data found for the selected criteria.")
\ No newline at end of file
+        zip_data, failed = process_territories(
+            {data_type: selected_territories for data_type in data_types}, resource_map
+        )
+        st.session_state["last_run"] = {"zip_data": zip_data, "failed": failed}
+
+show_last_run(resource_map)
\ No newline at end of file